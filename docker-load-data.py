@@ -9,8 +9,12 @@ DCS Lua files and load them into the database.
 import os
 import argparse
 import logging
-from lua_embedder import parse_and_store_lua_file
+from lua_embedder import (
+    parse_lua_file, embed_chunks, refresh_stats_view, load_stored_embeddings, bulk_insert_chunks,
+    EMBED_BATCH_SIZE, EMBED_CONCURRENCY
+)
 import psycopg2
+from pgvector.psycopg2 import register_vector
 from dotenv import load_dotenv
 
 # Configure logging
@@ -26,26 +30,86 @@ load_dotenv()
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://dcs_user:secure_password@db:5432/vectordb")
 
+# Number of buffered rows written per COPY
+COPY_BATCH_ROWS = int(os.getenv("COPY_BATCH_ROWS", "5000"))
+
+def copy_rows(conn, chunks):
+    """Write embedded chunks to lua_chunks in one bulk insert and commit."""
+    if not chunks:
+        return
+    bulk_insert_chunks(conn, chunks)
+    conn.commit()
+    logger.info(f"Copied {len(chunks)} chunks into the database")
+
+def drop_search_index(conn):
+    """Drop the full-text index before a bulk load. Returns True if it existed."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('lua_chunks_tsv_idx')")
+        if cursor.fetchone()[0] is None:
+            return False
+        cursor.execute("DROP INDEX lua_chunks_tsv_idx")
+    conn.commit()
+    logger.info("Dropped full-text index for bulk load")
+    return True
+
+def analyze_chunks(conn):
+    """Update planner statistics so new rows are served from the indexes."""
+    with conn.cursor() as cursor:
+        cursor.execute("ANALYZE lua_chunks")
+    conn.commit()
+
+def create_search_index(conn):
+    """Rebuild the full-text index after a bulk load."""
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE INDEX IF NOT EXISTS lua_chunks_tsv_idx ON lua_chunks USING GIN (content_tsv)")
+    conn.commit()
+    logger.info("Rebuilt full-text index")
+
+def iter_lua_files(directory_path):
+    """Yield the paths of all Lua files under a directory."""
+    for root, _, files in os.walk(directory_path):
+        for file in files:
+            if file.endswith('.lua'):
+                yield os.path.join(root, file)
+
 def process_directory(directory_path, conn, limit=None):
     """Process all Lua files in the specified directory."""
     if not os.path.exists(directory_path):
         logger.error(f"Directory not found: {directory_path}")
         return
 
-    count = 0
-    for root, _, files in os.walk(directory_path):
-        for file in files:
-            if file.endswith('.lua'):
-                file_path = os.path.join(root, file)
-                try:
-                    logger.info(f"Processing file: {file_path}")
-                    parse_and_store_lua_file(file_path, conn)
-                    count += 1
-                    if limit and count >= limit:
-                        logger.info(f"Reached file limit ({limit})")
-                        return
-                except Exception as e:
-                    logger.error(f"Error processing {file_path}: {e}")
+    index_dropped = drop_search_index(conn)
+    try:
+        pending = []
+        buffer = []
+        count = 0
+        for file_path in iter_lua_files(directory_path):
+            # parse_lua_file logs its own failures and returns None
+            pending.extend(parse_lua_file(file_path) or [])
+            count += 1
+            
+            # Embed once there is enough work to fill every in-flight request
+            if len(pending) >= EMBED_BATCH_SIZE * EMBED_CONCURRENCY:
+                load_stored_embeddings(conn, pending)
+                buffer.extend(embed_chunks(pending))
+                pending = []
+            
+            if len(buffer) >= COPY_BATCH_ROWS:
+                copy_rows(conn, buffer)
+                buffer = []
+            
+            if limit and count >= limit:
+                logger.info(f"Reached file limit ({limit})")
+                break
+        
+        load_stored_embeddings(conn, pending)
+        buffer.extend(embed_chunks(pending))
+        copy_rows(conn, buffer)
+    finally:
+        if index_dropped:
+            conn.rollback()
+            create_search_index(conn)
+    analyze_chunks(conn)
 
 def process_single_file(file_path, conn):
     """Process a single Lua file."""
@@ -57,9 +121,12 @@ def process_single_file(file_path, conn):
         logger.error(f"Not a Lua file: {file_path}")
         return
 
+    chunks = parse_lua_file(file_path)
+    if not chunks:
+        return
     try:
-        logger.info(f"Processing file: {file_path}")
-        parse_and_store_lua_file(file_path, conn)
+        load_stored_embeddings(conn, chunks)
+        copy_rows(conn, embed_chunks(chunks))
     except Exception as e:
         logger.error(f"Error processing {file_path}: {e}")
 
@@ -81,6 +148,7 @@ def main():
     try:
         # Connect to the database
         conn = psycopg2.connect(db_url)
+        register_vector(conn)
         logger.info("Connected to the database")
         
         if args.dir:
@@ -88,6 +156,7 @@ def main():
         elif args.single_file:
             process_single_file(args.single_file, conn)
         
+        refresh_stats_view(conn)
         conn.close()
         logger.info("Processing completed")
     except Exception as e:
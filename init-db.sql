@@ -1,6 +1,9 @@
 -- Enable the pgvector extension
 CREATE EXTENSION IF NOT EXISTS vector;
 
+-- Enable trigram matching for indexed ILIKE searches
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- Create the lua_chunks table if it doesn't exist
 CREATE TABLE IF NOT EXISTS lua_chunks (
     id SERIAL PRIMARY KEY,
@@ -10,12 +13,38 @@ CREATE TABLE IF NOT EXISTS lua_chunks (
     line_start INTEGER NOT NULL,
     line_end INTEGER NOT NULL,
     meta_data JSONB,
-    embedding VECTOR(384)
+    embedding HALFVEC(768),
+    content_sha BYTEA,
+    content_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED
 );
 
 -- Create indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_lua_chunks_file_path ON lua_chunks(file_path);
 CREATE INDEX IF NOT EXISTS idx_lua_chunks_chunk_type ON lua_chunks(chunk_type);
+CREATE INDEX IF NOT EXISTS lua_chunks_content_sha_idx ON lua_chunks(content_sha);
+CREATE INDEX IF NOT EXISTS lua_chunks_tsv_idx ON lua_chunks USING GIN (content_tsv);
+CREATE INDEX IF NOT EXISTS lua_chunks_content_trgm ON lua_chunks USING GIN (content gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS lua_chunks_emb_hnsw ON lua_chunks
+    USING hnsw (embedding halfvec_l2_ops) WITH (m = 16, ef_construction = 64);
+
+-- Precomputed counts for the API's /stats endpoint (refreshed by the loaders)
+CREATE MATERIALIZED VIEW IF NOT EXISTS lua_chunks_stats AS
+SELECT chunk_type, COUNT(*) AS snippets, COUNT(DISTINCT file_path) AS files,
+       GROUPING(chunk_type) AS is_total
+FROM lua_chunks
+GROUP BY GROUPING SETS ((chunk_type), ());
+
+-- Notify search caches when the data changes (one notification per statement)
+CREATE OR REPLACE FUNCTION lua_chunks_notify_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('lua_chunks_changed', TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER lua_chunks_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON lua_chunks
+    FOR EACH STATEMENT EXECUTE FUNCTION lua_chunks_notify_changed();
 
 -- Grant permissions
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO dcs_user;
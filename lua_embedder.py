@@ -7,13 +7,26 @@ and stores them in a PostgreSQL database with pgvector for efficient retrieval.
 """
 
 import os
+import io
+import struct
 import argparse
-import glob
+import asyncio
+import hashlib
+import threading
+import itertools
+import importlib.metadata
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterable, Optional
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from tqdm import tqdm
 import json
+import diskcache
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # Tree-sitter for Lua parsing
@@ -22,11 +35,13 @@ import tree_sitter_languages
 
 # Database
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2.extras import execute_values, Json
+import numpy as np
 import sqlalchemy as sa
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSONB
-from pgvector.sqlalchemy import Vector
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from pgvector.sqlalchemy import HALFVEC
+from pgvector.psycopg2 import register_vector
 
 # For embedding generation
 import openai
@@ -37,6 +52,8 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Load environment variables
 load_dotenv()
@@ -44,15 +61,44 @@ load_dotenv()
 # Configure Ollama (default)
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://SkyEye-Server:11434")
 OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text")
-OLLAMA_LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "codegemma")
+OLLAMA_LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "codegemma:7b-instruct-q4_K_M")
 USE_OLLAMA = os.getenv("USE_OLLAMA", "true").lower() == "true"
 
+# Shared HTTP session so Ollama requests reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                     max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# Number of chunks sent per embedding request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Number of embedding requests kept in flight at once
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# Parsed files waiting to be embedded
+PARSE_QUEUE_SIZE = int(os.getenv("PARSE_QUEUE_SIZE", "64"))
+# Times the parse pool is rebuilt after a worker dies (OOM, parser crash) before giving up
+PARSE_POOL_RESTARTS = int(os.getenv("PARSE_POOL_RESTARTS", "3"))
+# Persistent cache of chunk embeddings; set to an empty string to cache in memory only
+EMBED_CACHE_DIR = os.path.expanduser(os.getenv("EMBED_CACHE_DIR", "~/.cache/dcs_embed"))
+
+# Rows at which bulk_insert_chunks switches from a multi-row INSERT to a binary COPY
+COPY_MIN_ROWS = int(os.getenv("COPY_MIN_ROWS", "1000"))
+CHUNK_COLUMNS = ("file_path", "chunk_type", "content", "meta_data", "embedding",
+                 "line_start", "line_end", "parent_id", "content_sha")
+# Framing for COPY ... WITH (FORMAT binary)
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+
+# Persistent cache of parsed chunks; set to an empty string to disable
+PARSE_CACHE_DIR = os.path.expanduser(os.getenv("PARSE_CACHE_DIR", "~/.cache/dcs_lua"))
+# Bump when chunk_lua_file's output changes so stale parse cache entries are ignored
+CHUNKER_VERSION = "4"
+GRAMMAR_VERSION = f"{importlib.metadata.version('tree-sitter-languages')}/{CHUNKER_VERSION}"
+
 # Configure OpenAI (alternative)
 openai.api_key = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "text-embedding-3-small")
 
 # Setup SQLAlchemy
-from sqlalchemy.orm import declarative_base
 Base = declarative_base()
 
 class LuaChunk(Base):
@@ -63,110 +109,194 @@ class LuaChunk(Base):
     chunk_type = sa.Column(sa.String, nullable=False)  # 'function', 'table', 'comment', etc.
     content = sa.Column(sa.Text, nullable=False)
     meta_data = sa.Column(JSONB, nullable=True)  # Renamed from metadata to avoid conflict
-    embedding = sa.Column(Vector(768), nullable=True)  # 768 for nomic-embed-text
+    embedding = sa.Column(HALFVEC(768), nullable=True)  # 768 for nomic-embed-text, stored as float16
     line_start = sa.Column(sa.Integer, nullable=False)
     line_end = sa.Column(sa.Integer, nullable=False)
     parent_id = sa.Column(sa.Integer, sa.ForeignKey('lua_chunks.id'), nullable=True)
+    # sha256 of the embedding model and content, used to reuse embeddings already stored
+    content_sha = sa.Column(sa.LargeBinary, nullable=True)
+    # Full-text search vector, maintained by PostgreSQL
+    content_tsv = sa.Column(TSVECTOR, sa.Computed("to_tsvector('english', content)", persisted=True))
+    
+    __table_args__ = (
+        sa.Index('lua_chunks_tsv_idx', 'content_tsv', postgresql_using='gin'),
+        sa.Index('lua_chunks_content_sha_idx', 'content_sha'),
+    )
 
 def setup_database(conn_string: str) -> sa.engine.Engine:
     """Create database engine and tables if they don't exist."""
     engine = sa.create_engine(conn_string)
-    Base.metadata.create_all(engine)
+    # Skip create_all's per-table reflection when the schema is already in place
+    if not sa.inspect(engine).has_table(LuaChunk.__tablename__):
+        Base.metadata.create_all(engine)
     return engine
 
+# One parser per thread; a Parser must not be used by two threads at once
+_parser_local = threading.local()
+
 def get_lua_parser():
-    """Set up tree-sitter parser for Lua."""
+    """Set up tree-sitter parser for Lua, reusing it within the calling thread."""
+    parser = getattr(_parser_local, "parser", None)
+    if parser is not None:
+        return parser
     try:
         # Use the get_parser function which returns a pre-configured parser
         parser = tree_sitter_languages.get_parser('lua')
-        return parser
     except Exception as e:
         logger.error(f"Error getting Lua parser: {str(e)}")
         return None
+    _parser_local.parser = parser
+    return parser
+
+# Chunks shorter than this, ignoring surrounding whitespace, aren't worth embedding
+MIN_CHUNK_CHARS = 40
+
+# Top-level statements worth indexing, captured as @chunk, with the names they
+# declare captured as @name (functions) or @names (local variables)
+CHUNK_QUERY = tree_sitter_languages.get_language('lua').query("""
+(chunk [
+    (function_definition_statement name: (_) @name)
+    (local_function_definition_statement name: (_) @name)
+    (local_variable_declaration (variable_list (variable name: (identifier) @names)))
+    (local_variable_declaration)
+    (variable_assignment)
+    (comment)
+    (if_statement)
+    (for_numeric_statement)
+    (for_generic_statement)
+    (while_statement)
+    (repeat_statement)
+    (do_statement)
+] @chunk)
+""")
+
+def _set_name(metadata: Dict[str, Any], name: str):
+    metadata["name"] = name
+
+def _add_name(metadata: Dict[str, Any], name: str):
+    metadata.setdefault("names", []).append(name)
+
+# How each name capture in CHUNK_QUERY is recorded in the chunk's metadata
+NAME_CAPTURE_HANDLERS = {
+    "name": _set_name,
+    "names": _add_name,
+}
+
+# Opened lazily so forked worker processes each get their own handle
+_parse_cache = None
 
-def extract_node_text(node, source_bytes: bytes) -> str:
-    """Extract text from a tree-sitter node."""
-    return source_bytes[node.start_byte:node.end_byte].decode('utf-8')
-
-def get_node_line_range(node) -> Tuple[int, int]:
-    """Get the start and end line numbers for a node."""
-    return (node.start_point[0] + 1, node.end_point[0] + 1)
-
-def get_node_metadata(node, source_bytes: bytes) -> Dict[str, Any]:
-    """Extract metadata from a tree-sitter node."""
-    metadata = {
-        "node_type": node.type,
-    }
-    
-    # Extract names for functions and tables where possible
-    if node.type == "function_definition":
-        for child in node.children:
-            if child.type == "name":
-                metadata["name"] = extract_node_text(child, source_bytes)
-                break
-    elif node.type == "variable_declaration":
-        names = []
-        for child in node.children:
-            if child.type == "variable_list":
-                for name_node in child.children:
-                    if name_node.type == "identifier":
-                        names.append(extract_node_text(name_node, source_bytes))
-        if names:
-            metadata["names"] = names
-    
-    return metadata
+def get_parse_cache() -> Optional[diskcache.Cache]:
+    """Return the on-disk parse cache, or None if it is disabled."""
+    global _parse_cache
+    if _parse_cache is None and PARSE_CACHE_DIR:
+        _parse_cache = diskcache.Cache(os.path.join(PARSE_CACHE_DIR, "parse"))
+    return _parse_cache
 
 def chunk_lua_file(file_path: str, parser: Parser) -> List[Dict[str, Any]]:
-    """Parse a Lua file and chunk it into semantic parts using tree-sitter."""
+    """Parse a Lua file and chunk it into semantic parts using tree-sitter.
+    
+    Results are cached by the sha256 of the file's content and the grammar
+    version, so unchanged files are not parsed again.
+    """
     with open(file_path, 'rb') as f:
         source_bytes = f.read()
     
+    parse_cache = get_parse_cache()
+    key = hashlib.sha256(GRAMMAR_VERSION.encode("utf-8") + b"\0" + source_bytes).digest()
+    if parse_cache is not None:
+        cached = parse_cache.get(key)
+        if cached is not None:
+            chunks = json.loads(cached)
+            # Identical content may live at several paths
+            for chunk in chunks:
+                chunk["file_path"] = file_path
+                chunk["source"] = source_bytes
+            return chunks
+    
+    chunks = chunk_source(file_path, source_bytes, parser)
+    if parse_cache is not None:
+        parse_cache.set(key, json.dumps([
+            {k: v for k, v in chunk.items() if k != "source"} for chunk in chunks
+        ]))
+    return chunks
+
+def chunk_bytes(chunk: Dict[str, Any]) -> memoryview:
+    """Return a chunk's raw content as a view into its file's source bytes."""
+    start, end = chunk["content_span"]
+    return memoryview(chunk["source"])[start:end]
+
+def chunk_sha(chunk: Dict[str, Any]) -> bytes:
+    """Return the hash stored in lua_chunks.content_sha for a chunk.
+    
+    It covers the active embedding model as well as the content, so stored
+    embeddings are only reused for the model that produced them.
+    """
+    return embedding_cache_key(chunk_bytes(chunk))
+
+def chunk_content(chunk: Dict[str, Any]) -> str:
+    """Decode a chunk's content."""
+    start, end = chunk["content_span"]
+    return chunk["source"][start:end].decode('utf-8', errors='replace')
+
+def chunk_source(file_path: str, source_bytes: bytes, parser: Parser) -> List[Dict[str, Any]]:
+    """Chunk Lua source into semantic parts using tree-sitter.
+    
+    Chunks refer to their content by "content_span", a (start, end) byte range
+    into the shared "source" bytes; use chunk_content to decode it.
+    """
     tree = parser.parse(source_bytes)
     root_node = tree.root_node
     
     chunks = []
+    chunk_node = None
+    chunk = None
     
-    # Process nodes of interest
-    interesting_node_types = [
-        "function_definition",
-        "table_constructor",
-        "variable_declaration",
-        "assignment_statement",
-        "comment",
-        "if_statement",
-        "for_statement",
-        "while_statement",
-        "repeat_statement",
-        "do_statement",
-        "local_function"
-    ]
-    
-    def process_node(node, parent_id=None):
-        if node.type in interesting_node_types:
-            text = extract_node_text(node, source_bytes)
-            line_start, line_end = get_node_line_range(node)
+    # Captures come in document order, each @chunk before the names inside it;
+    # a declaration of several names yields one @chunk capture per name
+    for node, capture in CHUNK_QUERY.captures(root_node):
+        if capture == "chunk":
+            if node == chunk_node:
+                continue
+            previous_node, chunk_node = chunk_node, node
             
-            # Skip empty or very small chunks
-            if len(text.strip()) < 5:
-                return None
-                
-            chunk_id = len(chunks) + 1
-            chunks.append({
-                "id": chunk_id,
+            # Fold a comment into the comment directly above it
+            if (node.type == "comment" and chunks and chunks[-1]["chunk_type"] == "comment"
+                    and node.prev_sibling == previous_node
+                    and node.start_point[0] + 1 <= chunks[-1]["line_end"] + 1):
+                chunk = chunks[-1]
+                chunk["content_span"] = (chunk["content_span"][0], node.end_byte)
+                chunk["line_end"] = node.end_point[0] + 1
+                continue
+            
+            chunk = {
+                "id": None,
                 "file_path": file_path,
                 "chunk_type": node.type,
-                "content": text,
-                "metadata": get_node_metadata(node, source_bytes),
-                "line_start": line_start,
-                "line_end": line_end,
-                "parent_id": parent_id
-            })
-            return chunk_id
-        return None
+                "source": source_bytes,
+                "content_span": (node.start_byte, node.end_byte),
+                "metadata": {"node_type": node.type},
+                "line_start": node.start_point[0] + 1,
+                "line_end": node.end_point[0] + 1,
+                "parent_id": None
+            }
+            chunks.append(chunk)
+        elif chunk is not None:
+            name = source_bytes[node.start_byte:node.end_byte].decode('utf-8', errors='replace')
+            NAME_CAPTURE_HANDLERS[capture](chunk["metadata"], name)
     
-    # First pass to extract top-level chunks
-    for child in root_node.children:
-        process_node(child)
+    # Drop small chunks and repeats of earlier content in the file, so
+    # neither costs an embedding request
+    seen = set()
+    kept = []
+    for chunk in chunks:
+        start, end = chunk["content_span"]
+        content = source_bytes[start:end]
+        if len(content.strip()) < MIN_CHUNK_CHARS or content in seen:
+            continue
+        seen.add(content)
+        chunk["id"] = len(kept) + 1
+        kept.append(chunk)
+    chunks = kept
     
     # If we couldn't extract meaningful chunks, fallback to file-level chunking
     if not chunks:
@@ -174,7 +304,8 @@ def chunk_lua_file(file_path: str, parser: Parser) -> List[Dict[str, Any]]:
             "id": 1,
             "file_path": file_path,
             "chunk_type": "file",
-            "content": source_bytes.decode('utf-8', errors='replace'),
+            "source": source_bytes,
+            "content_span": (0, len(source_bytes)),
             "metadata": {"node_type": "file"},
             "line_start": 1,
             "line_end": root_node.end_point[0] + 1,
@@ -186,8 +317,7 @@ def chunk_lua_file(file_path: str, parser: Parser) -> List[Dict[str, Any]]:
 def generate_embedding(text: str) -> List[float]:
     """Generate an embedding for the given text."""
     if USE_OLLAMA:
-        import requests
-        response = requests.post(
+        response = SESSION.post(
             f"{OLLAMA_BASE_URL}/api/embeddings",
             json={"model": OLLAMA_EMBEDDING_MODEL, "prompt": text}
         )
@@ -202,42 +332,445 @@ def generate_embedding(text: str) -> List[float]:
         )
         return response.data[0].embedding
 
+def generate_embeddings_batch(texts: List[str]) -> List[List[float]]:
+    """Generate embeddings for several texts in a single request.
+    
+    Uses Ollama's batch /api/embed endpoint, falling back to one
+    /api/embeddings call per text on servers that don't support it.
+    """
+    if USE_OLLAMA:
+        response = SESSION.post(
+            f"{OLLAMA_BASE_URL}/api/embed",
+            json={"model": OLLAMA_EMBEDDING_MODEL, "input": texts},
+            timeout=60
+        )
+        embeddings = response.json().get("embeddings") if response.ok else None
+        if embeddings is None:
+            logger.warning("Batch embedding endpoint unavailable, falling back to /api/embeddings")
+            return [generate_embedding(text) for text in texts]
+        return embeddings
+    else:
+        # Fallback to OpenAI if Ollama is not enabled
+        if not openai.api_key:
+            raise ValueError("OpenAI API key not set and Ollama is disabled")
+        response = openai.Embedding.create(
+            model=OPENAI_MODEL,
+            input=texts
+        )
+        return [item.embedding for item in response.data]
+
+async def generate_embeddings_batch_async(client: httpx.AsyncClient, texts: List[str]) -> List[List[float]]:
+    """Async counterpart of generate_embeddings_batch using a shared httpx client."""
+    if not USE_OLLAMA:
+        return await asyncio.to_thread(generate_embeddings_batch, texts)
+    
+    response = await client.post(
+        f"{OLLAMA_BASE_URL}/api/embed",
+        json={"model": OLLAMA_EMBEDDING_MODEL, "input": texts}
+    )
+    embeddings = response.json().get("embeddings") if response.is_success else None
+    if embeddings is None:
+        logger.warning("Batch embedding endpoint unavailable, falling back to /api/embeddings")
+        embeddings = []
+        for text in texts:
+            response = await client.post(
+                f"{OLLAMA_BASE_URL}/api/embeddings",
+                json={"model": OLLAMA_EMBEDDING_MODEL, "prompt": text}
+            )
+            embeddings.append(response.json()["embedding"])
+    return embeddings
+
+# Embeddings keyed by sha256 of model and content, so duplicated chunks are embedded once
+_embed_cache: Dict[bytes, np.ndarray] = {}
+# Opened lazily so forked worker processes each get their own handle
+_embed_disk_cache = None
+
+def embedding_cache_key(content: bytes) -> bytes:
+    """Return the cache key for raw content under the active embedding model."""
+    model = OLLAMA_EMBEDDING_MODEL if USE_OLLAMA else OPENAI_MODEL
+    key = hashlib.sha256(f"{model}\0".encode("utf-8"))
+    key.update(content)
+    return key.digest()
+
+def get_embed_disk_cache() -> Optional[diskcache.Cache]:
+    """Return the on-disk embedding cache, or None if it is disabled."""
+    global _embed_disk_cache
+    if _embed_disk_cache is None and EMBED_CACHE_DIR:
+        _embed_disk_cache = diskcache.Cache(EMBED_CACHE_DIR)
+    return _embed_disk_cache
+
+def lookup_embedding(key: bytes) -> Optional[np.ndarray]:
+    """Return a cached embedding from memory or disk, or None."""
+    embedding = _embed_cache.get(key)
+    if embedding is None:
+        disk_cache = get_embed_disk_cache()
+        data = disk_cache.get(key) if disk_cache is not None else None
+        if data is not None:
+            embedding = _embed_cache[key] = np.frombuffer(data, dtype=np.float32)
+    return embedding
+
+def remember_embedding(key: bytes, embedding: List[float]) -> np.ndarray:
+    """Cache an embedding as float32 in memory and on disk."""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    _embed_cache[key] = embedding
+    disk_cache = get_embed_disk_cache()
+    if disk_cache is not None:
+        disk_cache.set(key, embedding.tobytes())
+    return embedding
+
+def chunks_iter(chunks: List[Any], size: int):
+    """Yield successive slices of at most size items."""
+    for i in range(0, len(chunks), size):
+        yield chunks[i:i + size]
+
+async def embed_chunks_async(chunks: List[Dict[str, Any]], client: httpx.AsyncClient,
+                             sem: asyncio.Semaphore) -> List[Dict[str, Any]]:
+    """Add an "embedding" to each chunk, sending batches concurrently.
+    
+    Only content not already in the embedding cache is sent, once per
+    distinct text. At most as many requests as the semaphore allows are in
+    flight at once. Returns the chunks that were embedded successfully.
+    """
+    async def embed(batch):
+        async with sem:
+            try:
+                return await generate_embeddings_batch_async(client, [chunk_content(chunk) for _, chunk in batch])
+            except Exception as e:
+                logger.error(f"Error generating embeddings for {len(batch)} chunks: {e}")
+                return None
+    
+    keys = [embedding_cache_key(chunk_bytes(chunk)) for chunk in chunks]
+    misses = {}
+    for chunk, key in zip(chunks, keys):
+        if key not in misses and lookup_embedding(key) is None:
+            misses[key] = chunk
+    
+    batches = list(chunks_iter(list(misses.items()), EMBED_BATCH_SIZE))
+    results = await asyncio.gather(*[embed(batch) for batch in batches])
+    for batch, embeddings in zip(batches, results):
+        if embeddings is None:
+            continue
+        for (key, _), embedding in zip(batch, embeddings):
+            remember_embedding(key, embedding)
+    
+    embedded = []
+    for chunk, key in zip(chunks, keys):
+        embedding = lookup_embedding(key)
+        if embedding is None:
+            continue
+        chunk["embedding"] = embedding
+        embedded.append(chunk)
+    return embedded
+
+async def _embed_chunks(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    async with httpx.AsyncClient(timeout=60) as client:
+        return await embed_chunks_async(chunks, client, asyncio.Semaphore(EMBED_CONCURRENCY))
+
+def embed_chunks(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Add an "embedding" to each chunk, batching requests to the embedding model.
+    
+    Returns the chunks that were embedded successfully.
+    """
+    return asyncio.run(_embed_chunks(chunks))
+
+def insert_chunk_rows(conn, chunks: List[Dict[str, Any]]) -> int:
+    """Insert embedded chunks with a single multi-row INSERT on a psycopg2 connection.
+    
+    The connection must have pgvector's register_vector applied. The caller
+    is responsible for committing. Returns the number of rows inserted.
+    """
+    rows = [
+        (
+            chunk["file_path"],
+            chunk["chunk_type"],
+            chunk_content(chunk),
+            Json(chunk["metadata"]),
+            np.asarray(chunk["embedding"], dtype=np.float32),
+            chunk["line_start"],
+            chunk["line_end"],
+            chunk.get("parent_id"),
+            chunk_sha(chunk),
+        )
+        for chunk in chunks
+    ]
+    with conn.cursor() as cursor:
+        execute_values(
+            cursor,
+            f"INSERT INTO lua_chunks ({', '.join(CHUNK_COLUMNS)}) VALUES %s",
+            rows,
+            template="(%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+            page_size=500
+        )
+    return len(rows)
+
+def encode_copy_row(chunk: Dict[str, Any]) -> bytes:
+    """Encode one embedded chunk in PostgreSQL's binary COPY format.
+    
+    The embedding is sent as pgvector's binary halfvec representation
+    (dimension, unused flag, big-endian float16 values) so the server
+    doesn't parse text.
+    """
+    embedding = chunk["embedding"]
+    parent_id = chunk.get("parent_id")
+    fields = (
+        chunk["file_path"].encode("utf-8"),
+        chunk["chunk_type"].encode("utf-8"),
+        chunk_content(chunk).encode("utf-8"),
+        b"\x01" + json.dumps(chunk["metadata"]).encode("utf-8"),  # jsonb format version 1
+        struct.pack("!hh", len(embedding), 0) + np.asarray(embedding, dtype=">f2").tobytes(),
+        struct.pack("!i", chunk["line_start"]),
+        struct.pack("!i", chunk["line_end"]),
+        None if parent_id is None else struct.pack("!i", parent_id),
+        chunk_sha(chunk),
+    )
+    return struct.pack("!h", len(fields)) + b"".join(
+        struct.pack("!i", -1) if field is None else struct.pack("!i", len(field)) + field
+        for field in fields
+    )
+
+def copy_chunk_rows(conn, chunks: List[Dict[str, Any]]) -> int:
+    """Write embedded chunks with a single binary COPY on a psycopg2 connection.
+    
+    The caller is responsible for committing. Returns the number of rows written.
+    """
+    buf = io.BytesIO()
+    buf.write(PGCOPY_HEADER)
+    for chunk in chunks:
+        buf.write(encode_copy_row(chunk))
+    buf.write(PGCOPY_TRAILER)
+    buf.seek(0)
+    with conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY lua_chunks ({', '.join(CHUNK_COLUMNS)}) FROM STDIN WITH (FORMAT binary)", buf)
+    return len(chunks)
+
+def bulk_insert_chunks(conn, chunks: List[Dict[str, Any]]) -> int:
+    """Insert embedded chunks using the fastest path for the batch size.
+    
+    Batches of COPY_MIN_ROWS or more go through binary COPY, smaller ones
+    through insert_chunk_rows. The caller is responsible for committing.
+    Returns the number of rows inserted.
+    """
+    if not chunks:
+        return 0
+    if len(chunks) >= COPY_MIN_ROWS:
+        return copy_chunk_rows(conn, chunks)
+    return insert_chunk_rows(conn, chunks)
+
+def load_stored_embeddings(conn, chunks: List[Dict[str, Any]]) -> int:
+    """Fill the in-memory embedding cache from stored rows with the same content.
+    
+    Content copied between files (mods, MIST and MOOSE forks) is then not
+    sent to the embedding model again. Stored embeddings are float16, so
+    they are not written to the disk cache. The connection must have
+    pgvector's register_vector applied. Returns the number of embeddings found.
+    """
+    missing = {chunk_sha(chunk) for chunk in chunks}
+    missing = [key for key in missing if lookup_embedding(key) is None]
+    if not missing:
+        return 0
+    
+    with conn.cursor() as cursor:
+        cursor.execute("""
+        SELECT DISTINCT ON (content_sha) content_sha, embedding
+        FROM lua_chunks
+        WHERE content_sha = ANY(%s) AND embedding IS NOT NULL
+        """, (missing,))
+        rows = cursor.fetchall()
+    
+    for sha, embedding in rows:
+        _embed_cache[bytes(sha)] = np.asarray(embedding.to_numpy(), dtype=np.float32)
+    return len(rows)
+
+def reuse_stored_embeddings(chunks: List[Dict[str, Any]], engine: sa.engine.Engine) -> int:
+    """load_stored_embeddings on a pooled connection from the engine."""
+    raw_conn = engine.raw_connection()
+    try:
+        conn = raw_conn.driver_connection
+        register_vector(conn)
+        return load_stored_embeddings(conn, chunks)
+    finally:
+        raw_conn.close()
+
+def insert_chunks(chunks: List[Dict[str, Any]], engine: sa.engine.Engine):
+    """Insert embedded chunks into the database in one transaction."""
+    if not chunks:
+        return
+    raw_conn = engine.raw_connection()
+    try:
+        conn = raw_conn.driver_connection
+        register_vector(conn)
+        bulk_insert_chunks(conn, chunks)
+        conn.commit()
+    finally:
+        raw_conn.close()
+
+async def store_chunks_async(chunks: List[Dict[str, Any]], engine: sa.engine.Engine,
+                             client: httpx.AsyncClient, sem: asyncio.Semaphore):
+    """Embed chunks concurrently, then store them without blocking the event loop."""
+    await asyncio.to_thread(reuse_stored_embeddings, chunks, engine)
+    chunks = await embed_chunks_async(chunks, client, sem)
+    await asyncio.to_thread(insert_chunks, chunks, engine)
+
 def store_chunks(chunks: List[Dict[str, Any]], engine: sa.engine.Engine):
     """Store chunks and their embeddings in the database."""
-    with engine.connect() as conn:
-        for chunk in tqdm(chunks, desc="Storing chunks"):
-            # Generate embedding
+    reuse_stored_embeddings(chunks, engine)
+    insert_chunks(embed_chunks(chunks), engine)
+
+def parse_and_store_lua_file(file_path: str, conn) -> int:
+    """Parse a Lua file and store its chunks using an open psycopg2 connection.
+    
+    The connection must have pgvector's register_vector applied.
+    
+    Returns the number of chunks stored.
+    """
+    parser = get_lua_parser()
+    if not parser:
+        raise RuntimeError("Failed to initialize Lua parser")
+    
+    chunks = chunk_lua_file(file_path, parser)
+    load_stored_embeddings(conn, chunks)
+    count = bulk_insert_chunks(conn, embed_chunks(chunks))
+    conn.commit()
+    return count
+
+def refresh_stats_view(conn):
+    """Refresh the lua_chunks_stats materialized view after loading data."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('lua_chunks_stats')")
+        if cursor.fetchone()[0] is None:
+            return
+        cursor.execute("REFRESH MATERIALIZED VIEW lua_chunks_stats")
+    conn.commit()
+    logger.info("Refreshed lua_chunks_stats")
+
+def parse_lua_file(file_path: str) -> Optional[List[Dict[str, Any]]]:
+    """Chunk one file with the calling thread's parser, logging failures.
+    
+    Runs in the parse worker processes, so it must stay a module-level function.
+    """
+    try:
+        logger.info(f"Processing {file_path}")
+        chunks = chunk_lua_file(file_path, get_lua_parser())
+    except Exception as e:
+        logger.error(f"Error processing file {file_path}: {str(e)}")
+        return None
+    if not chunks:
+        logger.warning(f"No chunks extracted from {file_path}")
+        return None
+    logger.info(f"Extracted {len(chunks)} chunks from {file_path}")
+    return chunks
+
+async def process_lua_files_async(lua_files: Iterable[str], db_engine: sa.engine.Engine,
+                                  parse_workers: Optional[int] = None) -> int:
+    """Parse, embed and store files as a producer/consumer pipeline.
+    
+    Files are parsed in a process pool, so both tree-sitter and the Python
+    chunk extraction run on every core, and only the chunk dicts come back.
+    Parsed files are handed to EMBED_CONCURRENCY consumers through a bounded
+    queue, so parsing runs ahead of embedding without holding every file's
+    chunks in memory. Embedding and database writes stay in this process; the
+    shared semaphore bounds in-flight embedding requests.
+    lua_files may be a lazy iterator; it is consumed as parsing proceeds.
+    Returns the number of files seen.
+    """
+    parse_workers = parse_workers or os.cpu_count() or 1
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+    parse_q = asyncio.Queue(maxsize=PARSE_QUEUE_SIZE)
+    pbar = tqdm(desc="Processing files")
+    file_count = 0
+    executor = ProcessPoolExecutor(max_workers=parse_workers)
+    pool_restarts = 0
+    # File and executor behind each parse task, for reporting failures
+    task_info = {}
+    
+    async def parse(file_path):
+        chunks = await loop.run_in_executor(executor, parse_lua_file, file_path)
+        if chunks:
+            await parse_q.put((file_path, chunks))
+        else:
+            pbar.update(1)
+    
+    def check_parsed(done):
+        """Report parse tasks that failed, rebuilding the pool if a worker died."""
+        nonlocal executor, pool_restarts
+        abort = None
+        for task in done:
+            file_path, task_executor = task_info.pop(task)
+            exc = task.exception()
+            if exc is None:
+                continue
+            logger.error(f"Error parsing file {file_path}: {exc!r}")
+            pbar.update(1)
+            # Every task on a dead pool fails; rebuild once per pool
+            if isinstance(exc, BrokenProcessPool) and task_executor is executor and abort is None:
+                executor.shutdown(wait=False, cancel_futures=True)
+                pool_restarts += 1
+                if pool_restarts > PARSE_POOL_RESTARTS:
+                    abort = RuntimeError(f"Parse workers died {pool_restarts} times, aborting")
+                    abort.__cause__ = exc
+                    continue
+                logger.warning(f"A parse worker died, restarting the pool ({pool_restarts}/{PARSE_POOL_RESTARTS})")
+                executor = ProcessPoolExecutor(max_workers=parse_workers)
+        if abort is not None:
+            raise abort
+    
+    async def produce():
+        nonlocal file_count
+        pending = set()
+        try:
+            for file_path in lua_files:
+                file_count += 1
+                if len(pending) >= parse_workers * 2:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    check_parsed(done)
+                task = asyncio.create_task(parse(file_path))
+                task_info[task] = (file_path, executor)
+                pending.add(task)
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                check_parsed(done)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            # Collect the cancelled and already failed tasks so none goes unretrieved
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise
+        for _ in range(EMBED_CONCURRENCY):
+            await parse_q.put(None)
+    
+    async def consume(client):
+        while (item := await parse_q.get()) is not None:
+            file_path, chunks = item
             try:
-                embedding = generate_embedding(chunk["content"])
-                chunk["embedding"] = embedding
+                await store_chunks_async(chunks, db_engine, client, sem)
             except Exception as e:
-                logger.error(f"Error generating embedding for chunk: {e}")
-                continue
-            
-            # Insert into database
-            stmt = sa.insert(LuaChunk).values(
-                file_path=chunk["file_path"],
-                chunk_type=chunk["chunk_type"],
-                content=chunk["content"],
-                meta_data=chunk["metadata"],
-                embedding=embedding,
-                line_start=chunk["line_start"],
-                line_end=chunk["line_end"],
-                parent_id=chunk["parent_id"]
-            )
-            conn.execute(stmt)
-            conn.commit()
+                logger.error(f"Error processing file {file_path}: {str(e)}")
+            pbar.update(1)
+    
+    try:
+        async with httpx.AsyncClient(timeout=60) as client:
+            consumers = [asyncio.create_task(consume(client)) for _ in range(EMBED_CONCURRENCY)]
+            try:
+                await produce()
+            except BaseException:
+                for consumer in consumers:
+                    consumer.cancel()
+                raise
+            await asyncio.gather(*consumers)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        pbar.close()
+    return file_count
 
-def process_lua_files(directory: str, db_engine: sa.engine.Engine):
+def process_lua_files(directory: str, db_engine: sa.engine.Engine, limit: Optional[int] = None):
     """Process all Lua files in a directory and its subdirectories."""
     try:
-        lua_files = glob.glob(f"{directory}/**/*.lua", recursive=True)
-        
-        if not lua_files:
-            logger.warning(f"No Lua files found in {directory}")
-            return
-        
-        logger.info(f"Found {len(lua_files)} Lua files to process")
+        # Walk the tree lazily so parsing starts before the walk finishes
+        lua_files = (str(path) for path in Path(directory).rglob("*.lua"))
+        if limit:
+            lua_files = itertools.islice(lua_files, limit)
+            logger.info(f"Limited to processing {limit} Lua files")
         
         # Get the Lua parser
         parser = get_lua_parser()
@@ -247,18 +780,8 @@ def process_lua_files(directory: str, db_engine: sa.engine.Engine):
             
         logger.info("Lua parser initialized successfully")
         
-        for file_path in tqdm(lua_files, desc="Processing files"):
-            try:
-                logger.info(f"Processing {file_path}")
-                chunks = chunk_lua_file(file_path, parser)
-                if chunks and len(chunks) > 0:
-                    logger.info(f"Extracted {len(chunks)} chunks from {file_path}")
-                    store_chunks(chunks, db_engine)
-                else:
-                    logger.warning(f"No chunks extracted from {file_path}")
-            except Exception as e:
-                logger.error(f"Error processing file {file_path}: {str(e)}")
-                continue
+        if not asyncio.run(process_lua_files_async(lua_files, db_engine)):
+            logger.warning(f"No Lua files found in {directory}")
     except Exception as e:
         logger.error(f"Error in process_lua_files: {str(e)}")
 
@@ -303,26 +826,15 @@ def main():
             except Exception as e:
                 logger.error(f"Error processing file {args.single_file}: {str(e)}")
                 raise
-        # Process multiple files with a limit
-        elif args.limit:
-            lua_files = glob.glob(f"{args.dir}/**/*.lua", recursive=True)[:args.limit]
-            logger.info(f"Limited to processing {len(lua_files)} Lua files")
-            for file_path in tqdm(lua_files, desc="Processing files"):
-                try:
-                    logger.info(f"Processing {file_path}")
-                    parser = get_lua_parser()
-                    if parser:
-                        chunks = chunk_lua_file(file_path, parser)
-                        if chunks and len(chunks) > 0:
-                            logger.info(f"Extracted {len(chunks)} chunks from {file_path}")
-                            store_chunks(chunks, engine)
-                        else:
-                            logger.warning(f"No chunks extracted from {file_path}")
-                except Exception as e:
-                    logger.error(f"Error processing file {file_path}: {str(e)}")
-        # Process all files in the directory
+        # Process all files in the directory, optionally limited
         else:
-            process_lua_files(args.dir, engine)
+            process_lua_files(args.dir, engine, args.limit)
+        
+        raw_conn = engine.raw_connection()
+        try:
+            refresh_stats_view(raw_conn)
+        finally:
+            raw_conn.close()
         
         logger.info("Processing complete")
     except Exception as e:
@@ -7,12 +7,19 @@ This script uses text search to find relevant code and streams the response from
 
 import os
 import argparse
+import functools
+import hashlib
 import logging
 import psycopg2
 import psycopg2.extras
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
+import numpy as np
+import diskcache
+from pgvector.psycopg2 import register_vector
 from dotenv import load_dotenv
 
 # Configure logging
@@ -24,61 +31,146 @@ load_dotenv()
 
 # Ollama configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://SkyEye-Server:11434")
-OLLAMA_LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "codegemma")
+OLLAMA_LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "codegemma:7b-instruct-q4_K_M")
+OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text")
+
+# Hybrid ranking weights for full-text rank and cosine similarity
+TEXT_RANK_WEIGHT = float(os.getenv("TEXT_RANK_WEIGHT", "0.3"))
+VECTOR_RANK_WEIGHT = float(os.getenv("VECTOR_RANK_WEIGHT", "0.7"))
+# Nearest neighbours fetched from the HNSW index per result before re-ranking
+VECTOR_CANDIDATES_PER_RESULT = 4
+
+# Shared HTTP session so Ollama requests reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                     max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# Persistent cache of query embeddings
+EMBED_CACHE_DIR = os.path.expanduser(os.getenv("EMBED_CACHE_DIR", "~/.cache/dcs_embed"))
+embedding_cache = diskcache.Cache(EMBED_CACHE_DIR)
 
 def connect_to_database(conn_string):
     """Connect to the database directly using psycopg2."""
     try:
         conn = psycopg2.connect(conn_string)
+        register_vector(conn)
         return conn
     except Exception as e:
         logger.error(f"Error connecting to database: {e}")
         return None
 
 def text_search(conn, query_text, limit=5):
-    """Search for content using text search."""
+    """Search for content using PostgreSQL full-text search.
+    
+    Matches are ranked with ts_rank_cd against the GIN-indexed content_tsv
+    column. If the full-text query finds nothing (e.g. the query is only stop
+    words), fall back to a keyword ILIKE match; queries without any keywords
+    return no results.
+    """
     try:
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
+        cursor.execute("""
+        SELECT id, file_path, chunk_type, content, meta_data, line_start, line_end
+        FROM lua_chunks, websearch_to_tsquery('english', %s) q
+        WHERE content_tsv @@ q
+        ORDER BY ts_rank_cd(content_tsv, q) DESC
+        LIMIT %s
+        """, (query_text, limit))
+        results = cursor.fetchall()
+        if results:
+            return results
+        
         # Create a list of keywords from the query
         keywords = query_text.lower().split()
         # Filter out common words
         keywords = [word for word in keywords if len(word) > 3]
         
-        # Build a query that matches any of the keywords
-        like_conditions = []
-        params = []
-        for word in keywords:
-            like_conditions.append("content ILIKE %s")
-            params.append(f"%{word}%")
-        
-        # Combine the conditions with OR
-        if like_conditions:
-            where_clause = " OR ".join(like_conditions)
-            query = f"""
-            SELECT id, file_path, chunk_type, content, meta_data, line_start, line_end
-            FROM lua_chunks
-            WHERE {where_clause}
-            LIMIT %s
-            """
-            params.append(limit)
-        else:
-            # Fallback if no keywords are found
-            query = """
-            SELECT id, file_path, chunk_type, content, meta_data, line_start, line_end
-            FROM lua_chunks
-            LIMIT %s
-            """
-            params = [limit]
-        
-        cursor.execute(query, params)
-        results = cursor.fetchall()
+        # Arbitrary chunks are no use as context, so keyword-less queries find nothing
+        if not keywords:
+            return []
         
-        return results
+        cursor.execute("""
+        SELECT id, file_path, chunk_type, content, meta_data, line_start, line_end
+        FROM lua_chunks
+        WHERE content ILIKE ANY(%s)
+        LIMIT %s
+        """, ([f"%{word}%" for word in keywords], limit))
+        return cursor.fetchall()
     except Exception as e:
+        conn.rollback()
         logger.error(f"Error searching with text: {e}")
         return []
 
+def generate_embedding(text):
+    """Embed the query text with Ollama, reusing cached results."""
+    return cached_embedding(OLLAMA_EMBEDDING_MODEL, text)
+
+@functools.lru_cache(maxsize=4096)
+def cached_embedding(model, text):
+    """Look up an embedding in memory, then on disk, then ask Ollama.
+    
+    Keys include the endpoint, since /api/embed returns normalized vectors
+    and /api/embeddings (used by direct_vector_query) does not.
+    """
+    key = hashlib.blake2b(f"api/embed\0{model}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+    data = embedding_cache.get(key)
+    if data is not None:
+        return np.frombuffer(data, dtype=np.float32)
+    
+    response = SESSION.post(
+        f"{OLLAMA_BASE_URL}/api/embed",
+        json={"model": model, "input": text},
+        timeout=30
+    )
+    response.raise_for_status()
+    embedding = np.asarray(response.json()["embeddings"][0], dtype=np.float32)
+    
+    embedding_cache.set(key, embedding.tobytes())
+    # Cached arrays are shared between callers
+    embedding.flags.writeable = False
+    return embedding
+
+def vector_search(conn, query_text, limit=5):
+    """Search for content with the HNSW embedding index and a hybrid rank.
+    
+    Nearest neighbours are fetched through the index, then re-ranked by a
+    weighted sum of full-text rank and cosine similarity to the query.
+    Returns an empty list if the query can't be embedded.
+    """
+    try:
+        query_vector = generate_embedding(query_text)
+    except Exception as e:
+        logger.error(f"Error generating query embedding: {e}")
+        return []
+    
+    try:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute("""
+        SELECT id, file_path, chunk_type, content, meta_data, line_start, line_end,
+               %(text_weight)s * ts_rank_cd(content_tsv, q)
+                 + %(vector_weight)s * (1 - (embedding <=> %(vector)s::halfvec)) AS score
+        FROM (
+            SELECT * FROM lua_chunks
+            ORDER BY embedding <-> %(vector)s::halfvec
+            LIMIT %(candidates)s
+        ) nearest, websearch_to_tsquery('english', %(query)s) q
+        ORDER BY score DESC
+        LIMIT %(limit)s
+        """, {
+            "vector": query_vector,
+            "query": query_text,
+            "text_weight": TEXT_RANK_WEIGHT,
+            "vector_weight": VECTOR_RANK_WEIGHT,
+            "candidates": limit * VECTOR_CANDIDATES_PER_RESULT,
+            "limit": limit,
+        })
+        return cursor.fetchall()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error searching with vector: {e}")
+        return []
+
 def generate_context_from_results(results):
     """Format the search results into context for the LLM."""
     if not results:
@@ -106,7 +198,7 @@ For code examples, always use proper Lua syntax and follow DCS scripting convent
 
         combined_prompt = f"System: {system_prompt}\n\nContext:\n{context}\n\nUser Question: {prompt}\n\nAnswer:"
         
-        response = requests.post(
+        response = SESSION.post(
             f"{OLLAMA_BASE_URL}/api/generate",
             json={
                 "model": OLLAMA_LLM_MODEL,
@@ -150,6 +242,7 @@ def main():
     parser.add_argument("--limit", type=int, default=5, help="Maximum number of results to return")
     parser.add_argument("--show-context", action="store_true", help="Show detailed context provided to the LLM")
     parser.add_argument("--temperature", type=float, default=0.1, help="Temperature for the LLM generation")
+    parser.add_argument("--text-only", action="store_true", help="Use full-text search only, without embeddings")
     
     args = parser.parse_args()
     
@@ -160,9 +253,16 @@ def main():
         return
     
     try:
-        # Search using text search
-        print(f"🔍 Searching for relevant code using text search: {args.query}")
-        results = text_search(conn, args.query, args.limit)
+        results = []
+        if not args.text_only:
+            # Search using vector embeddings with a hybrid rank
+            print(f"🔍 Searching for relevant code using vector search: {args.query}")
+            results = vector_search(conn, args.query, args.limit)
+        
+        if not results:
+            # Search using text search
+            print(f"🔍 Searching for relevant code using text search: {args.query}")
+            results = text_search(conn, args.query, args.limit)
         
         if not results:
             print("No relevant code found in the database.")
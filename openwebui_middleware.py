@@ -9,12 +9,20 @@ enhancing queries about DCS with relevant code snippets from the DCS Lua Analyze
 import os
 import json
 import logging
-import requests
+import re
+import httpx
 from typing import Dict, Any, List, Optional
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from dotenv import load_dotenv
 
+try:
+    import ahocorasick
+except ImportError:  # Optional; is_dcs_related falls back to a regex
+    ahocorasick = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -30,6 +38,9 @@ DCS_API_URL = os.getenv("DCS_API_URL", "http://host.docker.internal:8000")
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://host.docker.internal:11434")
 MIDDLEWARE_PORT = int(os.getenv("MIDDLEWARE_PORT", "8080"))
 
+# Hop-by-hop headers that must not be copied from the proxied response
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding"}
+
 # Create FastAPI app
 app = FastAPI(
     title="DCS Lua Analyzer Middleware",
@@ -46,16 +57,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def open_client():
+    """Create the shared HTTP client so requests reuse keep-alive connections."""
+    app.state.client = httpx.AsyncClient(
+        timeout=None,
+        transport=httpx.AsyncHTTPTransport(
+            retries=3,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+        )
+    )
+
+@app.on_event("shutdown")
+async def close_client():
+    """Close the shared HTTP client."""
+    await app.state.client.aclose()
+
+DCS_KEYWORDS = [
+    "dcs", "digital combat simulator", "eagle dynamics", 
+    "lua", "script", "mission editor", "waypoint", "aircraft", 
+    "helicopter", "trigger", "event", "flag", "moose", "miz", 
+    "mission", "map", "world", "spawn", "flight", "route"
+]
+# Keywords match anywhere in the text, so "scripting" counts as "script"
+DCS_KEYWORDS_RE = re.compile("|".join(map(re.escape, DCS_KEYWORDS)), re.IGNORECASE)
+
+def build_keyword_automaton():
+    """Compile the keywords into one Aho-Corasick automaton, if pyahocorasick is installed."""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for keyword in DCS_KEYWORDS:
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return automaton
+
+DCS_KEYWORDS_AUTOMATON = build_keyword_automaton()
+
 def is_dcs_related(text: str) -> bool:
-    """Check if a question is likely about DCS World."""
-    dcs_keywords = [
-        "dcs", "digital combat simulator", "eagle dynamics", 
-        "lua", "script", "mission editor", "waypoint", "aircraft", 
-        "helicopter", "trigger", "event", "flag", "moose", "miz", 
-        "mission", "map", "world", "spawn", "flight", "route"
-    ]
-    text_lower = text.lower()
-    return any(keyword in text_lower for keyword in dcs_keywords)
+    """Check if a question is likely about DCS World.
+    
+    The automaton scans the text once for all keywords; without it, the
+    regex tries every keyword at each position.
+    """
+    if DCS_KEYWORDS_AUTOMATON is not None:
+        return next(DCS_KEYWORDS_AUTOMATON.iter(text.lower()), None) is not None
+    return DCS_KEYWORDS_RE.search(text) is not None
 
 def extract_user_query(messages: List[Dict[str, Any]]) -> Optional[str]:
     """Extract the most recent user query from a list of messages."""
@@ -66,7 +113,11 @@ def extract_user_query(messages: List[Dict[str, Any]]) -> Optional[str]:
 
 @app.post("/api/chat/completions")
 async def chat_completions_proxy(request: Request):
-    """Proxy for OpenAI-compatible chat completions API."""
+    """Proxy for OpenAI-compatible chat completions API.
+    
+    The Ollama response is streamed back as it arrives rather than buffered.
+    """
+    client = app.state.client
     try:
         # Get request data
         data = await request.json()
@@ -87,7 +138,7 @@ async def chat_completions_proxy(request: Request):
             try:
                 # Get code context from DCS Lua Analyzer API
                 logger.info(f"Requesting context from DCS API at {DCS_API_URL}")
-                rag_response = requests.post(
+                rag_response = await client.post(
                     f"{DCS_API_URL}/rag_prompt",
                     json={"query": user_query, "limit": 5},
                     timeout=10
@@ -95,13 +146,17 @@ async def chat_completions_proxy(request: Request):
                 
                 if rag_response.status_code == 200:
                     rag_data = rag_response.json()
-                    enhanced_prompt = rag_data["prompt"]
+                    system_message, *query_messages = rag_data["messages"]
                     
-                    # Replace the last user message with the enhanced prompt
-                    new_messages = []
-                    for message in messages:
-                        if message.get("role") == "user" and message.get("content") == user_query:
-                            new_messages.append({"role": "user", "content": enhanced_prompt})
+                    # Put the static system prompt first so the model's prefix cache can
+                    # reuse it, and swap the last user message for the context + question
+                    new_messages = [system_message]
+                    last_user_index = max(
+                        i for i, message in enumerate(messages) if message.get("role") == "user"
+                    )
+                    for i, message in enumerate(messages):
+                        if i == last_user_index:
+                            new_messages.extend(query_messages)
                         else:
                             new_messages.append(message)
                     
@@ -115,17 +170,23 @@ async def chat_completions_proxy(request: Request):
         
         # Forward the request to Ollama
         logger.info(f"Forwarding request to Ollama at {OLLAMA_API_URL}")
-        ollama_response = requests.post(
+        ollama_request = client.build_request(
+            "POST",
             f"{OLLAMA_API_URL}/api/chat/completions",
             headers={"Content-Type": "application/json"},
             json=data
         )
+        ollama_response = await client.send(ollama_request, stream=True)
         
-        # Return the response from Ollama
-        return Response(
-            content=ollama_response.content,
+        # Stream the response from Ollama, passing the body through undecoded
+        return StreamingResponse(
+            ollama_response.aiter_raw(),
             status_code=ollama_response.status_code,
-            headers=dict(ollama_response.headers)
+            headers={
+                name: value for name, value in ollama_response.headers.items()
+                if name.lower() not in HOP_BY_HOP_HEADERS
+            },
+            background=BackgroundTask(ollama_response.aclose)
         )
     
     except Exception as e:
@@ -135,12 +196,13 @@ async def chat_completions_proxy(request: Request):
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
+    client = app.state.client
     dcs_api_healthy = False
     ollama_healthy = False
     
     try:
         logger.info(f"Testing connection to DCS API at {DCS_API_URL}")
-        dcs_resp = requests.get(f"{DCS_API_URL}/health", timeout=5)
+        dcs_resp = await client.get(f"{DCS_API_URL}/health", timeout=5)
         dcs_api_healthy = dcs_resp.status_code == 200
         logger.info(f"DCS API connection: {'OK' if dcs_api_healthy else 'FAILED'}")
     except Exception as e:
@@ -148,7 +210,7 @@ async def health_check():
     
     try:
         logger.info(f"Testing connection to Ollama at {OLLAMA_API_URL}")
-        ollama_resp = requests.get(f"{OLLAMA_API_URL}/api/tags", timeout=5)
+        ollama_resp = await client.get(f"{OLLAMA_API_URL}/api/tags", timeout=5)
         ollama_healthy = ollama_resp.status_code == 200
         logger.info(f"Ollama connection: {'OK' if ollama_healthy else 'FAILED'}")
     except Exception as e:
@@ -23,6 +23,89 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+def migrate_lua_chunks(cursor):
+    """Add search columns and indexes to an existing lua_chunks table."""
+    cursor.execute("SELECT to_regclass('lua_chunks')")
+    if cursor.fetchone()[0] is None:
+        logger.info("lua_chunks table not found, skipping migrations (run again after loading data)")
+        return
+    
+    # Store metadata as jsonb so drivers hand back dicts without reparsing
+    cursor.execute("""
+    SELECT data_type FROM information_schema.columns
+    WHERE table_name = 'lua_chunks' AND column_name = 'meta_data'
+    """)
+    row = cursor.fetchone()
+    if row and row[0] != 'jsonb':
+        cursor.execute("ALTER TABLE lua_chunks ALTER COLUMN meta_data TYPE jsonb USING meta_data::jsonb")
+        logger.info("Converted meta_data column to jsonb")
+    
+    # Full-text search column and GIN index used by the API server's text search
+    cursor.execute("""
+    ALTER TABLE lua_chunks ADD COLUMN IF NOT EXISTS content_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', content)) STORED
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS lua_chunks_tsv_idx ON lua_chunks USING GIN (content_tsv)")
+    logger.info("Full-text search column and index are in place")
+    
+    # Hash of embedding model and content so loaders can reuse embeddings already
+    # stored; it is computed by the loaders, so existing rows are left without one
+    cursor.execute("ALTER TABLE lua_chunks ADD COLUMN IF NOT EXISTS content_sha bytea")
+    cursor.execute("CREATE INDEX IF NOT EXISTS lua_chunks_content_sha_idx ON lua_chunks (content_sha)")
+    logger.info("Content hash column and index are in place")
+    
+    # Trigram index so substring ILIKE searches can use an index
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    cursor.execute("CREATE INDEX IF NOT EXISTS lua_chunks_content_trgm ON lua_chunks USING GIN (content gin_trgm_ops)")
+    logger.info("Trigram index is in place")
+    
+    # Store embeddings as float16 halfvec to halve heap and index size (pgvector >= 0.7)
+    cursor.execute("""
+    SELECT format_type(atttypid, NULL), atttypmod FROM pg_attribute
+    WHERE attrelid = 'lua_chunks'::regclass AND attname = 'embedding'
+    """)
+    row = cursor.fetchone()
+    if row and row[0] == 'vector':
+        # atttypmod holds the declared dimensions, or -1 if there are none
+        halfvec_type = f"halfvec({row[1]})" if row[1] > 0 else "halfvec"
+        # The old index uses vector operators and can't survive the type change
+        cursor.execute("DROP INDEX IF EXISTS lua_chunks_emb_hnsw")
+        cursor.execute(f"ALTER TABLE lua_chunks ALTER COLUMN embedding TYPE {halfvec_type} USING embedding::{halfvec_type}")
+        logger.info(f"Converted embedding column to {halfvec_type}")
+    
+    # Approximate nearest-neighbour index for vector search
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS lua_chunks_emb_hnsw ON lua_chunks
+        USING hnsw (embedding halfvec_l2_ops) WITH (m = 16, ef_construction = 64)
+    """)
+    logger.info("HNSW embedding index is in place")
+    
+    # Precomputed counts served by the API's /stats endpoint, refreshed after each load
+    cursor.execute("""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS lua_chunks_stats AS
+    SELECT chunk_type, COUNT(*) AS snippets, COUNT(DISTINCT file_path) AS files,
+           GROUPING(chunk_type) AS is_total
+    FROM lua_chunks
+    GROUP BY GROUPING SETS ((chunk_type), ())
+    """)
+    logger.info("Statistics view is in place")
+    
+    # Tell search caches (simple_ollama_rag) to drop their results when the data changes
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION lua_chunks_notify_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('lua_chunks_changed', TG_OP);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """)
+    cursor.execute("""
+    CREATE OR REPLACE TRIGGER lua_chunks_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON lua_chunks
+        FOR EACH STATEMENT EXECUTE FUNCTION lua_chunks_notify_changed()
+    """)
+    logger.info("Change notification trigger is in place")
+
 def setup_existing_database(conn_params):
     """Set up pgvector extension on the existing database."""
     try:
@@ -38,6 +121,8 @@ def setup_existing_database(conn_params):
             else:
                 cursor.execute("CREATE EXTENSION vector")
                 logger.info("pgvector extension installed successfully")
+            
+            migrate_lua_chunks(cursor)
         
         conn.close()
         return True
@@ -6,18 +6,24 @@ This script uses direct SQL for search and a simplified approach for Ollama.
 """
 
 import os
+import re
+import asyncio
 import argparse
 import logging
-import psycopg2
-import psycopg2.extras
-import json
-import requests
-import time
+import httpx
+import orjson
+import psycopg
+from psycopg import sql
+from psycopg.rows import dict_row
+from psycopg.types.json import set_json_loads
+from psycopg_pool import AsyncConnectionPool
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Load environment variables
 load_dotenv()
@@ -25,97 +31,378 @@ load_dotenv()
 # Ollama configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://SkyEye-Server:11434")
 OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text")
-OLLAMA_LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "codegemma")
+OLLAMA_LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "codegemma:7b-instruct-q4_K_M")
+# How long Ollama keeps the model loaded after a request
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "8192"))
+# Concurrent generations allowed, matching the server's parallel slots
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
 
-def connect_to_database(conn_string):
-    """Connect to the database directly using psycopg2."""
+# Static system prompt, kept byte-identical across requests so Ollama can reuse its KV cache
+SYSTEM_PROMPT = """You are an expert DCS World Lua programming assistant. 
+Your task is to answer questions about DCS scripting by analyzing the relevant code snippets provided.
+Always focus on providing practical, working code examples when possible.
+If the provided context doesn't fully address the question, say so and provide your best guess based on general Lua and DCS knowledge.
+For code examples, always use proper Lua syntax and follow DCS scripting conventions."""
+
+# Characters of each chunk sent to the LLM, and how many of them precede the match
+SNIPPET_CHARS = 800
+SNIPPET_LEAD_CHARS = 200
+# Snippets from the same file this many lines apart or closer are merged into one
+MERGE_LINE_GAP = 5
+
+# Snippet search over lua_chunks, completed with the trigram or full-text filter
+_TEXT_SEARCH_SQL = sql.SQL("""
+SELECT id, file_path, chunk_type,
+       substring(content, w.start, %(snippet_chars)s) AS content,
+       char_length(content) > %(snippet_chars)s AS truncated,
+       meta_data, line_start, line_end
+FROM {table},
+     LATERAL (SELECT greatest(1, least(
+         strpos(lower(content), lower(%(term)s)) - %(lead_chars)s,
+         char_length(content) - %(snippet_chars)s + 1
+     )) AS start) w
+WHERE {where}
+LIMIT %(limit)s
+""")
+TRGM_SEARCH_SQL = _TEXT_SEARCH_SQL.format(
+    table=sql.Identifier("lua_chunks"),
+    where=sql.SQL("content ILIKE %(pattern)s"),
+)
+# Stop words such as "if" or "do" make an empty tsquery; those terms fall back to ILIKE
+TSV_SEARCH_SQL = _TEXT_SEARCH_SQL.format(
+    table=sql.Identifier("lua_chunks"),
+    where=sql.SQL("content_tsv @@ plainto_tsquery('english', %(term)s)"
+                  " OR (numnode(plainto_tsquery('english', %(term)s)) = 0 AND content ILIKE %(pattern)s)"),
+)
+
+# Database pool sizing
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "4"))
+# Server-side prepare a statement after it has run this many times on a connection
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "1"))
+
+# Process-wide connection pool, kept warm across queries when imported as a library
+db_pool = None
+
+# text_search results keyed on (normalized query, limit); cleared when lua_chunks changes
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "300"))
+search_cache = TTLCache(maxsize=256, ttl=SEARCH_CACHE_TTL)
+# Notification channel raised by the lua_chunks_changed trigger (see setup_db.py)
+CHANGES_CHANNEL = "lua_chunks_changed"
+_listener_task = None
+
+# Shared HTTP client, reused across calls when imported as a library
+_client = None
+# Token text of an in-progress /api/chat stream frame, matched without parsing the frame
+STREAM_CONTENT_RE = re.compile(rb'"content":"((?:[^"\\]|\\.)*)"')
+# Request bodies are serialized with orjson and sent as raw content
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Limits in-flight query_ollama calls to OLLAMA_NUM_PARALLEL
+_ollama_slots = None
+
+def get_client():
+    """Return the module-level Ollama HTTP client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=None,
+            transport=httpx.AsyncHTTPTransport(
+                retries=3,
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=OLLAMA_NUM_PARALLEL)
+            )
+        )
+    return _client
+
+async def configure_connection(conn):
+    """Decode jsonb columns with orjson on every pooled connection."""
+    set_json_loads(orjson.loads, conn)
+
+async def listen_for_changes(conn_string):
+    """Clear the search cache whenever lua_chunks is modified."""
+    try:
+        async with await psycopg.AsyncConnection.connect(conn_string, autocommit=True) as conn:
+            await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(CHANGES_CHANNEL)))
+            async for _ in conn.notifies():
+                search_cache.clear()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Stopped listening for lua_chunks changes: {e}")
+
+async def connect_to_database(conn_string, watch_changes=True):
+    """Return the process-wide connection pool, opening it on first use.
+    
+    With watch_changes, a background task also listens for changes to
+    lua_chunks so cached search results never outlive a data load.
+    """
+    global db_pool, _listener_task
+    if db_pool is not None:
+        return db_pool
     try:
-        conn = psycopg2.connect(conn_string)
-        return conn
+        pool = AsyncConnectionPool(
+            conn_string,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            kwargs={"row_factory": dict_row, "prepare_threshold": DB_PREPARE_THRESHOLD},
+            configure=configure_connection,
+            open=False,
+        )
+        await pool.open(wait=True)
+        db_pool = pool
+        if watch_changes:
+            _listener_task = asyncio.create_task(listen_for_changes(conn_string))
+        return db_pool
     except Exception as e:
         logger.error(f"Error connecting to database: {e}")
         return None
 
-def text_search(conn, query_text, limit=5):
-    """Search for content using text search."""
+async def close_resources():
+    """Close the connection pool and the HTTP client."""
+    global db_pool
+    if _listener_task is not None:
+        _listener_task.cancel()
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+    if _client is not None:
+        await _client.aclose()
+
+async def text_search(conn, query_text, limit=5):
+    """Search for content using text search.
+    
+    Substring ILIKE matches are served by the pg_trgm GIN index, which needs
+    at least 3 characters; shorter queries use the full-text index instead,
+    unless they are stop words, which are matched with an unindexed ILIKE.
+    
+    Only a SNIPPET_CHARS window of each chunk around the first occurrence of
+    the query is returned as content; truncated is set when the chunk is longer.
+    
+    Both searches are case-insensitive, so results are cached on the stripped,
+    lowercased query.
+    """
+    query_text = query_text.strip().lower()
+    key = (query_text, limit)
+    cached = search_cache.get(key)
+    if cached is not None:
+        # Hand out copies so callers can't modify the cached rows
+        return [dict(row) for row in cached]
+    
     try:
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        # Use text search with ILIKE
-        query = """
-        SELECT id, file_path, chunk_type, content, meta_data, line_start, line_end
-        FROM lua_chunks
-        WHERE content ILIKE %s
-        LIMIT %s
-        """
+        # Trigram-indexed ILIKE for 3+ characters, full-text search otherwise
+        query = TRGM_SEARCH_SQL if len(query_text) >= 3 else TSV_SEARCH_SQL
+        params = {
+            "term": query_text,
+            "pattern": f'%{query_text}%',
+            "snippet_chars": SNIPPET_CHARS,
+            "lead_chars": SNIPPET_LEAD_CHARS,
+            "limit": limit,
+        }
         
-        cursor.execute(query, (f'%{query_text}%', limit))
-        results = cursor.fetchall()
+        async with conn.cursor() as cursor:
+            # Prepared server-side on first use, then reused by the pooled connection
+            await cursor.execute(query, params, prepare=True)
+            results = await cursor.fetchall()
         
-        return results
+        search_cache[key] = results
+        return [dict(row) for row in results]
     except Exception as e:
         logger.error(f"Error searching with text: {e}")
         return []
 
+def merge_names(prev, row):
+    """Combine the metadata names of two merged snippets into prev."""
+    names = [
+        meta_data['name'] for meta_data in (prev['meta_data'], row['meta_data'])
+        if meta_data and meta_data.get('name')
+    ]
+    if len(names) > 1 and names[1] not in names[0].split(', '):
+        prev['meta_data'] = {**prev['meta_data'], 'name': ", ".join(names)}
+    elif names and not (prev['meta_data'] and prev['meta_data'].get('name')):
+        prev['meta_data'] = {**(prev['meta_data'] or {}), 'name': names[0]}
+
+def merge_results(results):
+    """Drop duplicate snippets and merge nearby ones from the same file.
+    
+    Rows with identical content (code copied between mods) are kept once.
+    The rest are ordered by file and line, and a snippet starting within
+    MERGE_LINE_GAP lines of the previous one's end is spliced onto it by
+    line number: lines already present are skipped, and a gap is marked
+    with a comment naming the omitted lines. Names from both snippets are
+    kept. Truncated snippets don't cover their full line range, so they are
+    never merged.
+    """
+    seen = set()
+    unique = []
+    for row in results:
+        if row['content'] not in seen:
+            seen.add(row['content'])
+            unique.append(dict(row))
+    unique.sort(key=lambda row: (row['file_path'], row['line_start']))
+    
+    merged = []
+    for row in unique:
+        prev = merged[-1] if merged else None
+        if (prev is None or row['file_path'] != prev['file_path']
+                or row['line_start'] > prev['line_end'] + MERGE_LINE_GAP
+                or prev.get('truncated') or row.get('truncated')):
+            merged.append(row)
+            continue
+        if row['line_end'] <= prev['line_end']:
+            # Already covered by the previous snippet
+            merge_names(prev, row)
+            continue
+        
+        overlap = prev['line_end'] - row['line_start'] + 1
+        if overlap > 0:
+            prev['content'] += "\n" + "\n".join(row['content'].split("\n")[overlap:])
+        elif overlap < 0:
+            gap_start, gap_end = prev['line_end'] + 1, row['line_start'] - 1
+            omitted = f"line {gap_start}" if gap_start == gap_end else f"lines {gap_start}-{gap_end}"
+            prev['content'] += f"\n-- ... ({omitted} omitted)\n" + row['content']
+        else:
+            prev['content'] += "\n" + row['content']
+        prev['line_end'] = row['line_end']
+        merge_names(prev, row)
+        if row['chunk_type'] not in prev['chunk_type'].split('+'):
+            prev['chunk_type'] += '+' + row['chunk_type']
+    return merged
+
 def generate_context_from_results(results):
     """Format the search results into context for the LLM."""
     if not results:
         return "No relevant DCS Lua code found in the database."
     
+    results = merge_results(results)
     context_parts = []
+    append = context_parts.append
     
     for i, result in enumerate(results, 1):
-        file_info = f"File: {result['file_path']} (Lines {result['line_start']}-{result['line_end']})"
-        if result['meta_data'] and 'name' in result['meta_data'] and result['meta_data']['name']:
-            file_info += f" - {result['meta_data']['name']}"
-        
-        context_parts.append(f"# Code Snippet {i} ({result['chunk_type']})\n{file_info}\n```lua\n{result['content']}\n```\n")
+        meta_data = result['meta_data']
+        name = f" - {meta_data['name']}" if meta_data and meta_data.get('name') else ""
+        truncated = " (truncated)" if result.get('truncated') else ""
+        append(
+            f"# Code Snippet {i} ({result['chunk_type']}){truncated}\n"
+            f"File: {result['file_path']} (Lines {result['line_start']}-{result['line_end']}){name}\n"
+            f"```lua\n{result['content']}\n```\n"
+        )
     
     return "\n".join(context_parts)
 
-def query_ollama(prompt, context, temperature=0.1):
-    """Query Ollama with the context and prompt."""
+def parse_stream_frame(frame, parts):
+    """Append the response text of one newline-delimited stream frame.
+    
+    Token frames only need their content string, so it is cut out of the raw
+    bytes and only that JSON string literal is decoded. The final frame,
+    which carries the generation stats, is parsed in full.
+    """
+    if not frame.strip():
+        return
+    match = STREAM_CONTENT_RE.search(frame)
+    if match and b'"done":false' in frame:
+        parts.append(orjson.loads(b'"' + match.group(1) + b'"'))
+        return
     try:
-        system_prompt = """You are an expert DCS World Lua programming assistant. 
-Your task is to answer questions about DCS scripting by analyzing the relevant code snippets provided.
-Always focus on providing practical, working code examples when possible.
-If the provided context doesn't fully address the question, say so and provide your best guess based on general Lua and DCS knowledge.
-For code examples, always use proper Lua syntax and follow DCS scripting conventions."""
+        json_line = orjson.loads(frame)
+        if 'message' in json_line:
+            parts.append(json_line['message'].get('content', ''))
+        if json_line.get('done'):
+            logger.debug(f"Generated {json_line.get('eval_count')} tokens in {json_line.get('eval_duration', 0) / 1e9:.2f}s")
+    except orjson.JSONDecodeError:
+        logger.error(f"Error decoding JSON: {frame}")
 
-        combined_prompt = f"System: {system_prompt}\n\nContext:\n{context}\n\nUser Question: {prompt}\n\nAnswer:"
-        
-        response = requests.post(
+async def warm_up_ollama():
+    """Load the model ahead of the first query so it isn't loaded on the critical path."""
+    try:
+        await get_client().post(
             f"{OLLAMA_BASE_URL}/api/generate",
-            json={
-                "model": OLLAMA_LLM_MODEL,
-                "prompt": combined_prompt,
-                "temperature": temperature,
-                "stream": True
-            },
-            stream=True
+            content=orjson.dumps({"model": OLLAMA_LLM_MODEL, "keep_alive": OLLAMA_KEEP_ALIVE}),
+            headers=JSON_HEADERS
         )
-        
-        # Handle streaming response
-        if response.status_code == 200:
-            full_response = ""
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        json_line = json.loads(line.decode('utf-8'))
-                        if 'response' in json_line:
-                            full_response += json_line['response']
-                    except json.JSONDecodeError:
-                        logger.error(f"Error decoding JSON: {line}")
-            return full_response
-        else:
-            logger.error(f"Error from Ollama API: {response.text}")
-            return f"Error: Failed to get response from the model. Status code: {response.status_code}"
+    except Exception as e:
+        logger.warning(f"Error warming up Ollama: {e}")
+
+async def check_model_quantization():
+    """Log the quantization of the LLM, warning if it runs unquantized."""
+    try:
+        response = await get_client().post(
+            f"{OLLAMA_BASE_URL}/api/show",
+            content=orjson.dumps({"model": OLLAMA_LLM_MODEL}),
+            headers=JSON_HEADERS
+        )
+        response.raise_for_status()
+        level = orjson.loads(response.content).get("details", {}).get("quantization_level", "unknown")
+    except Exception as e:
+        logger.warning(f"Error checking model quantization: {e}")
+        return
+    if level.upper() in ("F16", "BF16", "F32"):
+        logger.warning(f"{OLLAMA_LLM_MODEL} is unquantized ({level}); a Q4_K_M tag decodes several times faster")
+    else:
+        logger.info(f"{OLLAMA_LLM_MODEL} quantization: {level}")
+
+async def prepare_model():
+    """Warm up the LLM and report its quantization."""
+    await asyncio.gather(warm_up_ollama(), check_model_quantization())
+
+async def query_ollama(prompt, context, temperature=0.1):
+    """Query Ollama with the context and prompt.
+    
+    The system prompt is sent as its own leading chat message so the
+    prefill for it can be served from Ollama's prompt cache.
+    """
+    try:
+        # Ollama streams by default; identity encoding keeps frames unbuffered
+        async with get_client().stream(
+            "POST",
+            f"{OLLAMA_BASE_URL}/api/chat",
+            content=orjson.dumps({
+                "model": OLLAMA_LLM_MODEL,
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {prompt}"}
+                ],
+                "options": {"temperature": temperature, "num_ctx": OLLAMA_NUM_CTX},
+                "keep_alive": OLLAMA_KEEP_ALIVE
+            }),
+            headers={**JSON_HEADERS, "Accept-Encoding": "identity"}
+        ) as response:
+            # Handle streaming response
+            if response.status_code == 200:
+                parts = []
+                buf = bytearray()
+                async for chunk in response.aiter_raw(8192):
+                    buf += chunk
+                    # Only parse complete frames; keep the residual for the next read
+                    while (nl := buf.find(b'\n')) != -1:
+                        frame = bytes(buf[:nl])
+                        del buf[:nl + 1]
+                        parse_stream_frame(frame, parts)
+                parse_stream_frame(bytes(buf), parts)
+                return "".join(parts)
+            else:
+                body = await response.aread()
+                logger.error(f"Error from Ollama API: {body.decode('utf-8', errors='replace')}")
+                return f"Error: Failed to get response from the model. Status code: {response.status_code}"
     
     except Exception as e:
         logger.error(f"Error querying Ollama: {e}")
         return f"Error: {str(e)}"
 
-def main():
+async def submit_query(prompt, context, temperature=0.1):
+    """Run query_ollama once one of the server's parallel slots is free.
+    
+    Concurrent callers share the OLLAMA_NUM_PARALLEL slots, so Ollama
+    decodes their requests together while extra requests wait here instead
+    of queueing on the server.
+    """
+    global _ollama_slots
+    if _ollama_slots is None:
+        _ollama_slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    async with _ollama_slots:
+        return await query_ollama(prompt, context, temperature)
+
+async def main_async():
     """Main entry point."""
     parser = argparse.ArgumentParser(description="Simple Ollama RAG for DCS Lua Database")
     parser.add_argument("query", type=str, help="The search query")
@@ -128,16 +415,23 @@ def main():
     
     args = parser.parse_args()
     
+    # Load the model and check its quantization while the database is searched
+    warmup_task = asyncio.create_task(prepare_model())
+    
     # Connect to the database
-    conn = connect_to_database(args.db_url)
-    if not conn:
+    # A single query won't outlive the cache, so don't watch for changes
+    pool = await connect_to_database(args.db_url, watch_changes=False)
+    if not pool:
         logger.error("Failed to connect to the database.")
+        warmup_task.cancel()
+        await close_resources()
         return
     
     try:
         # Search using text search
         print(f"🔍 Searching for relevant code using text search: {args.query}")
-        results = text_search(conn, args.query, args.limit)
+        async with pool.connection() as conn:
+            results = await text_search(conn, args.query, args.limit)
         
         if not results:
             print("No relevant code found in the database.")
@@ -148,9 +442,9 @@ def main():
         # Generate context from results
         context = generate_context_from_results(results)
         
-        # Query the LLM
+        # Query the LLM, letting prefill start while the context is printed
         print(f"💬 Querying {OLLAMA_LLM_MODEL} with your question...")
-        llm_response = query_ollama(args.query, context, args.temperature)
+        llm_task = asyncio.create_task(submit_query(args.query, context, args.temperature))
         
         # Format and display the output
         if args.show_context:
@@ -158,11 +452,17 @@ def main():
             print(context)
             print("\n" + "=" * 80 + "\n")
             
+        llm_response = await llm_task
         print("\n# Response\n")
         print(llm_response)
         
     finally:
-        conn.close()
+        warmup_task.cancel()
+        await close_resources()
+
+def main():
+    """Run the async entry point."""
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
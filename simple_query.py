@@ -3,12 +3,20 @@
 Simple Query for DCS Lua Database
 
 This script performs a basic text search against the Lua chunks database.
+
+Cold-cache searches read many small pages. On PostgreSQL 18+ on Linux, the
+server can issue those reads through io_uring; --info warns when it doesn't:
+
+    io_method = io_uring
+    effective_io_concurrency = 64
+    maintenance_io_concurrency = 64
 """
 
 import os
 import argparse
 import logging
 import psycopg2
+from psycopg2 import sql
 from dotenv import load_dotenv
 
 # Configure logging
@@ -18,6 +26,56 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Search statements, filled in with $n parameters when prepared and %(name)s when streamed
+SEARCH_SQL = sql.SQL("""
+    SELECT id, file_path, chunk_type, content, line_start, line_end
+    FROM {table}
+    WHERE {where}
+    ORDER BY id
+    LIMIT {limit}
+""")
+SEARCH_FILTERS = {
+    # Substring match, served by the pg_trgm GIN index
+    "lua_search_trgm": "content ILIKE {term}",
+    # Full-text match for terms too short for trigrams; stop words such as "if"
+    # or "do" make an empty tsquery, so those fall back to a substring scan
+    "lua_search_tsv": "content_tsv @@ plainto_tsquery('english', {term})"
+                      " OR (numnode(plainto_tsquery('english', {term})) = 0"
+                      " AND strpos(lower(content), lower({term})) > 0)",
+}
+
+def search_statement(name, term, limit):
+    """Compose the named search with the given parameter placeholders."""
+    return SEARCH_SQL.format(
+        table=sql.Identifier("lua_chunks"),
+        where=sql.SQL(SEARCH_FILTERS[name]).format(term=sql.SQL(term)),
+        limit=sql.SQL(limit),
+    )
+
+# Prepared on each connection by prepare_search_statements
+PREPARED_SEARCH_SQL = {
+    name: sql.SQL("PREPARE {name} AS ").format(name=sql.Identifier(name)) + search_statement(name, "$1", "$2")
+    for name in SEARCH_FILTERS
+}
+# Runs a prepared search
+EXECUTE_SEARCH_SQL = {
+    name: sql.SQL("EXECUTE {name}(%s, %s)").format(name=sql.Identifier(name)) for name in SEARCH_FILTERS
+}
+# Run through a server-side cursor for large searches
+STREAMED_SEARCH_SQL = {name: search_statement(name, "%(term)s", "%(limit)s") for name in SEARCH_FILTERS}
+
+# Searches for more rows than this are streamed through a server-side cursor
+STREAM_MIN_ROWS = 100
+# Rows fetched per round trip when streaming
+STREAM_ITERSIZE = 64
+
+def prepare_search_statements(conn):
+    """PREPARE the search statements on a new connection."""
+    with conn.cursor() as cursor:
+        for statement in PREPARED_SEARCH_SQL.values():
+            cursor.execute(statement)
+    conn.commit()
+
 def connect_to_database(conn_string):
     """Connect to the database directly using psycopg2."""
     try:
@@ -28,37 +86,45 @@ def connect_to_database(conn_string):
         return None
 
 def search_by_content(conn, search_term, limit=10):
-    """Search for text in the content field."""
-    try:
-        cursor = conn.cursor()
-        
+    """Search for text in the content field, yielding matching rows.
+    
+    Expects prepare_search_statements() to have run on the connection.
+    
+    Substring ILIKE matches are served by the pg_trgm GIN index, which needs
+    at least 3 characters; shorter terms use the full-text index instead,
+    unless they are stop words, which are matched with a substring scan.
+    Up to STREAM_MIN_ROWS rows are fetched at once with the prepared
+    statements; larger searches stream through a server-side cursor so only
+    STREAM_ITERSIZE rows are held in memory.
+    """
+    if len(search_term) >= 3:
         # Basic text search using ILIKE for case-insensitive matching
-        query = """
-        SELECT id, file_path, chunk_type, content, line_start, line_end
-        FROM lua_chunks
-        WHERE content ILIKE %s
-        ORDER BY id
-        LIMIT %s
-        """
-        
-        cursor.execute(query, (f'%{search_term}%', limit))
-        results = cursor.fetchall()
+        name, term = "lua_search_trgm", f'%{search_term}%'
+    else:
+        name, term = "lua_search_tsv", search_term
+    
+    try:
+        if limit <= STREAM_MIN_ROWS:
+            with conn.cursor() as cursor:
+                cursor.execute(EXECUTE_SEARCH_SQL[name], (term, limit))
+                yield from cursor.fetchall()
+            return
         
-        return results
+        # DECLARE can't wrap EXECUTE, so the streamed search is planned per call
+        with conn.cursor(name) as cursor:
+            cursor.itersize = STREAM_ITERSIZE
+            cursor.execute(STREAMED_SEARCH_SQL[name], {"term": term, "limit": limit})
+            yield from cursor
     except Exception as e:
         logger.error(f"Error searching database: {e}")
-        return []
 
 def print_results(results, detailed=False):
-    """Print search results."""
-    if not results:
-        print("No results found.")
-        return
-    
-    print(f"Found {len(results)} results:")
-    print("-" * 80)
-    
+    """Print search results as they arrive, followed by the result count."""
+    count = 0
     for i, (id, file_path, chunk_type, content, line_start, line_end) in enumerate(results, 1):
+        if i == 1:
+            print("-" * 80)
+        count = i
         print(f"[{i}] {file_path}:{line_start}-{line_end} ({chunk_type})")
         
         if detailed:
@@ -69,6 +135,37 @@ def print_results(results, detailed=False):
                 print("    " + lines[0][:100] + ("..." if len(lines[0]) > 100 else ""))
         
         print("-" * 80)
+    
+    if count:
+        print(f"Found {count} results.")
+    else:
+        print("No results found.")
+
+# Server settings recommended for the scans behind lua_chunks
+RECOMMENDED_IO_SETTINGS = {
+    "io_method": "io_uring",
+    "effective_io_concurrency": "64",
+    "maintenance_io_concurrency": "64",
+}
+
+def check_server_config(conn):
+    """Warn about I/O settings that slow cold-cache scans of lua_chunks.
+    
+    Returns the server's current values of RECOMMENDED_IO_SETTINGS; settings
+    the server doesn't know (io_method before PostgreSQL 18) are None.
+    """
+    settings = {}
+    with conn.cursor() as cursor:
+        for name, recommended in RECOMMENDED_IO_SETTINGS.items():
+            # missing_ok, so older servers return NULL instead of raising
+            cursor.execute("SELECT current_setting(%s, true)", (name,))
+            value = cursor.fetchone()[0]
+            settings[name] = value
+            if value is None:
+                logger.warning(f"Server has no {name} setting; PostgreSQL 18+ is needed for {name} = {recommended}")
+            elif value != recommended and not (value.isdigit() and int(value) >= int(recommended)):
+                logger.warning(f"Server {name} is {value}; {recommended} is recommended for cold-cache scans")
+    return settings
 
 def get_table_info(conn):
     """Get information about the lua_chunks table."""
@@ -104,6 +201,10 @@ def get_table_info(conn):
         result = f"Table lua_chunks exists with {row_count} rows.\nColumns:\n"
         for col in columns:
             result += f"- {col[0]}: {col[1]} (nullable: {col[2]})\n"
+        
+        result += "Server I/O settings:\n"
+        for name, value in check_server_config(conn).items():
+            result += f"- {name}: {value if value is not None else 'unsupported'}\n"
             
         return result
     
@@ -143,6 +244,7 @@ def main():
             return
         
         # Search and display results
+        prepare_search_statements(conn)
         results = search_by_content(conn, args.query, args.limit)
         print_results(results, args.detailed)
         
@@ -6,32 +6,43 @@ This script tests the middleware by sending a sample DCS-related query
 and comparing the response with a direct query to Ollama.
 """
 
+import io
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration
 MIDDLEWARE_URL = "http://localhost:8080"
 OLLAMA_URL = "http://localhost:11434"
 MODEL = "codegemma"  # Change to match your available model
 
-def test_health():
+# Shared session so the probes reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.headers["Content-Type"] = "application/json"
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                     max_retries=Retry(total=3, backoff_factor=0.2,
+                                                       status_forcelist=[502, 503, 504])))
+
+def test_health(out=None):
     """Test the middleware health endpoint."""
-    print("\n=== Testing Middleware Health ===\n")
+    print("\n=== Testing Middleware Health ===\n", file=out)
     try:
-        resp = requests.get(f"{MIDDLEWARE_URL}/health")
-        health_data = resp.json()
-        print(f"Health Status: {resp.status_code}")
-        print(json.dumps(health_data, indent=2))
+        resp = SESSION.get(f"{MIDDLEWARE_URL}/health")
+        health_data = orjson.loads(resp.content)
+        print(f"Health Status: {resp.status_code}", file=out)
+        print(orjson.dumps(health_data, option=orjson.OPT_INDENT_2).decode(), file=out)
         return resp.status_code == 200
     except Exception as e:
-        print(f"Error checking middleware health: {e}")
+        print(f"Error checking middleware health: {e}", file=out)
         return False
 
-def test_dcs_query():
+def test_dcs_query(out=None):
     """Test the middleware with a DCS-related query."""
-    print("\n=== Testing DCS-Related Query ===\n")
+    print("\n=== Testing DCS-Related Query ===\n", file=out)
     dcs_query = "How do I create waypoints for AI aircraft in DCS World?"
     
     # Create a simple query payload
@@ -43,19 +54,19 @@ def test_dcs_query():
     }
     
     try:
-        print(f"Sending DCS query to middleware: {dcs_query}")
+        print(f"Sending DCS query to middleware: {dcs_query}", file=out)
         start_time = time.time()
-        resp = requests.post(
+        resp = SESSION.post(
             f"{MIDDLEWARE_URL}/api/chat/completions",
-            json=payload
+            data=orjson.dumps(payload)
         )
         end_time = time.time()
         
-        print(f"Status code: {resp.status_code}")
-        print(f"Response time: {end_time - start_time:.2f} seconds")
+        print(f"Status code: {resp.status_code}", file=out)
+        print(f"Response time: {end_time - start_time:.2f} seconds", file=out)
         
         if resp.status_code == 200:
-            response_data = resp.json()
+            response_data = orjson.loads(resp.content)
             
             # Extract and print the response content
             content = None
@@ -66,31 +77,31 @@ def test_dcs_query():
                     content = response_data["choices"][0]["delta"].get("content")
             
             if content:
-                print("\nResponse excerpt (first 300 chars):")
-                print(content[:300] + "...")
+                print("\nResponse excerpt (first 300 chars):", file=out)
+                print(content[:300] + "...", file=out)
                 
                 # Check if the response includes code snippets or DCS-specific information
                 contains_lua = "lua" in content.lower() or "function" in content.lower()
                 contains_dcs_terms = any(term in content.lower() for term in 
                                         ["waypoint", "mission", "dcs", "aircraft"])
                 
-                print(f"\nResponse contains Lua code references: {contains_lua}")
-                print(f"Response contains DCS-specific terms: {contains_dcs_terms}")
+                print(f"\nResponse contains Lua code references: {contains_lua}", file=out)
+                print(f"Response contains DCS-specific terms: {contains_dcs_terms}", file=out)
                 
                 return contains_lua or contains_dcs_terms
             else:
-                print("No content found in response")
+                print("No content found in response", file=out)
                 return False
         else:
-            print(f"Error response: {resp.text}")
+            print(f"Error response: {resp.text}", file=out)
             return False
     except Exception as e:
-        print(f"Error testing DCS query: {e}")
+        print(f"Error testing DCS query: {e}", file=out)
         return False
 
-def test_non_dcs_query():
+def test_non_dcs_query(out=None):
     """Test the middleware with a non-DCS-related query."""
-    print("\n=== Testing Non-DCS-Related Query ===\n")
+    print("\n=== Testing Non-DCS-Related Query ===\n", file=out)
     non_dcs_query = "What is the capital of France?"
     
     # Create a simple query payload
@@ -102,43 +113,51 @@ def test_non_dcs_query():
     }
     
     try:
-        print(f"Sending non-DCS query to middleware: {non_dcs_query}")
+        print(f"Sending non-DCS query to middleware: {non_dcs_query}", file=out)
         start_time = time.time()
-        resp = requests.post(
+        resp = SESSION.post(
             f"{MIDDLEWARE_URL}/api/chat/completions",
-            json=payload
+            data=orjson.dumps(payload)
         )
         end_time = time.time()
         
-        print(f"Status code: {resp.status_code}")
-        print(f"Response time: {end_time - start_time:.2f} seconds")
+        print(f"Status code: {resp.status_code}", file=out)
+        print(f"Response time: {end_time - start_time:.2f} seconds", file=out)
         
         if resp.status_code == 200:
             # For non-DCS queries, we expect a quick response time since no enhancement is needed
-            print(f"Response was appropriately fast for non-DCS query: {end_time - start_time < 1.0}")
+            print(f"Response was appropriately fast for non-DCS query: {end_time - start_time < 1.0}", file=out)
             return True
         else:
-            print(f"Error response: {resp.text}")
+            print(f"Error response: {resp.text}", file=out)
             return False
     except Exception as e:
-        print(f"Error testing non-DCS query: {e}")
+        print(f"Error testing non-DCS query: {e}", file=out)
         return False
 
 def main():
     """Run all tests."""
     print("=== DCS Lua Analyzer Middleware Test ===")
     
+    # The probes are independent, so run them concurrently and print each
+    # one's output in order once they have all finished
+    tests = (test_health, test_dcs_query, test_non_dcs_query)
+    outputs = [io.StringIO() for _ in tests]
+    with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+        futures = [executor.submit(test, out) for test, out in zip(tests, outputs)]
+        health_ok, dcs_ok, non_dcs_ok = [future.result() for future in futures]
+    
     # Test 1: Check middleware health
-    health_ok = test_health()
+    print(outputs[0].getvalue(), end="")
     if not health_ok:
         print("\n❌ Health check failed. Please check that the middleware is running.")
         sys.exit(1)
     
     # Test 2: Test with DCS-related query
-    dcs_ok = test_dcs_query()
+    print(outputs[1].getvalue(), end="")
     
     # Test 3: Test with non-DCS-related query
-    non_dcs_ok = test_non_dcs_query()
+    print(outputs[2].getvalue(), end="")
     
     # Print summary
     print("\n=== Test Summary ===\n")